@@ -18,9 +18,14 @@
 """
 
 import csv
+import os
 import sys
 import argparse
+import functools
+import heapq
 import io
+import operator
+from concurrent.futures import ProcessPoolExecutor
 
 # IBKR 交易所代码 → TradingView 前缀
 EXCHANGE_MAP = {
@@ -31,21 +36,50 @@ EXCHANGE_MAP = {
     "ARCA": "AMEX",
 }
 
+# 需要转换的 Activity Statement section，其余 section（持仓、业绩汇总等）解析时直接跳过
+CONVERTED_SECTIONS = frozenset(("交易", "存款和取款", "股息", "代扣税"))
+
+# 股票交易的 Side，其余 Side 均为 $CASH 现金记录
+TRADE_SIDES = frozenset(("Buy", "Sell"))
+
+# 输出列；各 convert_* 函数返回的每行都是按此顺序排列的 tuple
 TV_FIELDNAMES = ["Symbol", "Side", "Qty", "Fill Price", "Commission", "Closing Time"]
 
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+def iter_csv_rows(filepath):
+    """逐行读取 CSV 文件，返回由 list[str] 组成的迭代器。
+
+    分词交给标准库 csv 模块（其 reader 由 C 扩展 _csv 实现），对调用方只暴露 list-of-lists，
+    解析逻辑无需关心底层读取方式。
+    """
+    with open(filepath, newline="", encoding="utf-8-sig") as f:
+        yield from csv.reader(f)
+
 
 def build_symbol_exchange_map(flex_files):
     """从 Flex Query 文件构建 Symbol → TradingView 前缀 的映射表。"""
     mapping = {}
+    # 同一 Symbol 以首次出现的交易所为准
+    set_default = mapping.setdefault
+    exchange_get = EXCHANGE_MAP.get
     for filepath in flex_files:
-        with open(filepath, newline="", encoding="utf-8-sig") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                sym = row.get("Symbol", "").strip()
-                ex = row.get("ListingExchange", "").strip()
-                if sym and ex and sym not in mapping:
-                    tv_ex = EXCHANGE_MAP.get(ex, ex)
-                    mapping[sym] = tv_ex
+        rows = iter_csv_rows(filepath)
+        header = next(rows, [])
+        # 只需两列：按表头定位一次列号，避免 DictReader 为每行构建 dict
+        if "Symbol" not in header or "ListingExchange" not in header:
+            continue
+        sym_i = header.index("Symbol")
+        ex_i = header.index("ListingExchange")
+        min_len = max(sym_i, ex_i) + 1
+        for row in rows:
+            if len(row) < min_len:
+                continue
+            sym = row[sym_i].strip()
+            ex = row[ex_i].strip()
+            if sym and ex:
+                set_default(sym, exchange_get(ex, ex))
     return mapping
 
 
@@ -59,231 +93,312 @@ def get_tv_symbol(symbol, currency, symbol_exchange_map):
     return f"{exchange}:{symbol}"
 
 
-def parse_activity_statement(filepath):
-    """解析 IBKR Activity Statement CSV，按 section 分组返回数据。
+class TvSymbolResolver(dict):
+    """(代码, 货币) → TradingView Symbol 的查找表，每个 Activity Statement 构建一个。
+
+    同一标的通常有多笔成交：命中时只是一次 dict 下标访问，不经过 HKD 分支和映射表查找；
+    未命中时由 __missing__ 调用 get_tv_symbol 解析并缓存（结果驻留，供去重时按指针判等）。
+    键为原始字段值，strip 只在首次解析时进行。
+    """
+
+    def __init__(self, symbol_exchange_map):
+        super().__init__()
+        self.symbol_exchange_map = symbol_exchange_map
+
+    def __missing__(self, key):
+        symbol, currency = key
+        tv_symbol = sys.intern(get_tv_symbol(symbol.strip(), currency.strip(), self.symbol_exchange_map))
+        self[key] = tv_symbol
+        return tv_symbol
+
+
+def pad_section_columns(section):
+    """把 section 中较短的列用空字符串补齐到 section["size"]。
+
+    同一 section 可能出现多个 Header 行且字段不同，只出现在部分 Header 中的列需要补齐，
+    以保证所有列按行号对齐。
+    """
+    size = section["size"]
+    for column in section["columns"].values():
+        if len(column) < size:
+            column.extend([""] * (size - len(column)))
+
+
+def parse_activity_statement(filepath, wanted=None):
+    """解析 IBKR Activity Statement CSV，按 section 分组返回按列存储的数据。
+
+    返回值格式及 wanted 参数见 parse_sections。
+    """
+    return parse_sections(iter_csv_rows(filepath), wanted)
+
+
+def parse_sections(rows, wanted=None):
+    """把 Activity Statement 的 CSV 行（list[str] 的可迭代对象）按 section 分组，按列存储。
 
-    返回 dict：{section_name: [{"field1": val, ...}, ...]}
+    wanted 为 section 名称的集合时，只保留这些 section，其余行不做字段拆分与存储；
+    为 None 时保留全部 section。
+
+    返回 dict：{section_name: {"headers": [...], "columns": {field: [val, ...]}, "size": n}}
+    每个字段对应一列，各列长度均为 size（即该 section 的 Data 行数）。
 
     注意：IBKR 某些 section（如 "交易"）的 header 中存在重复字段名（如 "代码" 出现两次）。
-    为避免 dict 覆盖，重复的字段名会加上 "_2"、"_3" 后缀。
+    为避免列覆盖，重复的字段名会加上 "_2"、"_3" 后缀。
     """
     sections = {}
     current_section = None
     current_headers = None
+    # 当前 section 的表，以及与 current_headers 一一对应的列 list；
+    # 在 Header 行按字段名解析一次，Data 行按位置直接追加，无需再按字段名查找
+    table = None
+    current_columns = None
 
-    with open(filepath, newline="", encoding="utf-8-sig") as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if len(row) < 2:
-                continue
-            section = row[0].strip()
-            row_type = row[1].strip()
-
+    for row in rows:
+        if len(row) < 2:
+            continue
+        section = row[0].strip()
+        row_type = row[1].strip()
+        if wanted is not None and section not in wanted:
+            # 未保留 section 的 Header 同样会结束上一个 section
             if row_type == "Header":
-                current_section = section
-                raw_headers = row[2:]
-                # 处理重复字段名：第二次出现的加 "_2" 后缀
-                seen_headers = {}
-                deduped = []
-                for h in raw_headers:
-                    if h in seen_headers:
-                        seen_headers[h] += 1
-                        deduped.append(f"{h}_{seen_headers[h]}")
-                    else:
-                        seen_headers[h] = 1
-                        deduped.append(h)
-                current_headers = deduped
-                if section not in sections:
-                    sections[section] = []
-            elif row_type == "Data" and current_section == section and current_headers:
-                data = row[2:]
-                # 补齐或截断到 header 长度
-                while len(data) < len(current_headers):
-                    data.append("")
-                record = dict(zip(current_headers, data))
-                sections[section].append(record)
+                current_section = None
+            continue
 
+        if row_type == "Header":
+            # section 名与字段名会作为 dict 键被反复查找，驻留后与代码中的同名常量共享同一对象，
+            # 查找时可直接按指针判等。只在 Header 行驻留：对每个 Data 行调用 sys.intern 的开销
+            # 反而高于它省下的字符串比较。
+            section = sys.intern(section)
+            current_section = section
+            raw_headers = [sys.intern(h) for h in row[2:]]
+            # 处理重复字段名：第二次出现的加 "_2" 后缀
+            seen_headers = {}
+            deduped = []
+            for h in raw_headers:
+                if h in seen_headers:
+                    seen_headers[h] += 1
+                    deduped.append(f"{h}_{seen_headers[h]}")
+                else:
+                    seen_headers[h] = 1
+                    deduped.append(h)
+            current_headers = deduped
+            if section not in sections:
+                sections[section] = {"headers": [], "columns": {}, "size": 0}
+            table = sections[section]
+            columns = table["columns"]
+            pad_section_columns(table)
+            for h in current_headers:
+                if h not in columns:
+                    table["headers"].append(h)
+                    columns[h] = [""] * table["size"]
+            current_columns = [columns[h] for h in current_headers]
+        elif row_type == "Data" and current_section == section and current_headers:
+            data = row[2:]
+            # 补齐到 header 长度（多出的字段由下面的 zip 截断）
+            missing = len(current_headers) - len(data)
+            if missing > 0:
+                data += [""] * missing
+            for column, v in zip(current_columns, data):
+                column.append(v)
+            table["size"] += 1
+
+    for table in sections.values():
+        pad_section_columns(table)
     return sections
 
 
-def convert_trades(records, symbol_exchange_map):
-    """将交易记录转换为 TradingView 格式。"""
-    rows = []
-    for r in records:
-        if r.get("DataDiscriminator") != "Order":
-            continue
-        if r.get("资产分类") != "股票":
-            continue
+def section_columns(section, *names):
+    """按字段名取出 section 的若干列。
 
-        symbol = r["代码"].strip()
-        currency = r["货币"].strip()
-        tv_symbol = get_tv_symbol(symbol, currency, symbol_exchange_map)
-
-        qty_raw = float(r["数量"])
-        side = "Buy" if qty_raw > 0 else "Sell"
-        qty = abs(qty_raw)
-        price = r["交易价格"].strip()
-        commission = abs(float(r["佣金/税"])) if r["佣金/税"].strip() else ""
-
-        # 日期格式："2025-08-14, 11:32:43" → "2025-08-14 11:32:43"
-        dt = r["日期/时间"].strip().replace(", ", " ")
-
-        rows.append({
-            "Symbol": tv_symbol,
-            "Side": side,
-            "Qty": qty,
-            "Fill Price": price,
-            "Commission": commission,
-            "Closing Time": dt,
-        })
-    return rows
+    列中保存的是原始字段值（未 strip）：各 convert_* 函数只对筛选后真正输出的行和字段 strip，
+    而 str.strip() 对无首尾空白的字符串直接返回原对象，不会产生新的分配；
+    在解析阶段或按整列预先 strip 反而要处理更多不需要的值。
+    section 为 None（文件中没有该 section）或不含某字段时，对应列为等长的空字符串列表。
+    """
+    if section is None:
+        return [[] for _ in names]
+    columns = section["columns"]
+    return [columns[n] if n in columns else [""] * section["size"] for n in names]
 
 
-def convert_cash_transactions(records, side_label):
+def convert_trades(section, symbol_exchange_map):
+    """将交易记录转换为 TradingView 格式。
+
+    按列批量处理：先筛出股票成交（Order）所在的行号，再逐列整体转换，最后一次拼成输出行。
+    """
+    (discriminators, asset_classes, symbols, currencies,
+     quantities, prices, commissions, times) = section_columns(
+        section, "DataDiscriminator", "资产分类", "代码", "货币", "数量", "交易价格", "佣金/税", "日期/时间",
+    )
+    keep = [
+        i for i, (discriminator, asset_class) in enumerate(zip(discriminators, asset_classes))
+        if discriminator == "Order" and asset_class == "股票"
+    ]
+
+    tv_symbol_of = TvSymbolResolver(symbol_exchange_map)
+    tv_symbols = [tv_symbol_of[symbols[i], currencies[i]] for i in keep]
+    _float = float
+    _abs = abs
+    qty_raw = [_float(quantities[i]) for i in keep]
+    sides = ["Buy" if q > 0 else "Sell" for q in qty_raw]
+    qty_abs = list(map(_abs, qty_raw))
+    fill_prices = [prices[i].strip() for i in keep]
+    commission_strs = [commissions[i] for i in keep]
+    commission_abs = [_abs(_float(c)) if c.strip() else "" for c in commission_strs]
+    # 日期格式："2025-08-14, 11:32:43" → "2025-08-14 11:32:43"
+    closing_times = [times[i].strip().replace(", ", " ") for i in keep]
+
+    return list(zip(tv_symbols, sides, qty_abs, fill_prices, commission_abs, closing_times))
+
+
+def convert_cash_transactions(section, side_label):
     """将存款/取款记录转换为 TradingView $CASH 格式。
     side_label: 'Deposit' 或 'Withdrawal'
     正数金额 → Deposit，负数金额 → Withdrawal
     """
+    _float = float
+    _abs = abs
     rows = []
-    for r in records:
+    for desc, amount_str, dt in zip(*section_columns(section, "描述", "金额", "结算日期")):
         # 跳过汇总行
-        desc = r.get("描述", "").strip()
-        if not desc:
+        if not desc.strip():
             continue
-        amount_str = r.get("金额", "").strip()
-        if not amount_str:
+        # float() 本身忽略首尾空白，这里只需判断是否为空
+        if not amount_str.strip():
             continue
-        amount = float(amount_str)
+        amount = _float(amount_str)
 
         if amount > 0:
             side = "Deposit"
         else:
             side = "Withdrawal"
-            amount = abs(amount)
+            amount = _abs(amount)
 
-        dt = r.get("结算日期", "").strip()
+        dt = dt.strip()
         if dt:
             dt += " 0:00:00"
 
-        rows.append({
-            "Symbol": "$CASH",
-            "Side": side,
-            "Qty": amount,
-            "Fill Price": "",
-            "Commission": "",
-            "Closing Time": dt,
-        })
+        rows.append(("$CASH", side, amount, "", "", dt))
     return rows
 
 
-def convert_dividends(records):
+def convert_dividends(section):
     """将股息记录转换为 TradingView $CASH Dividend 格式。"""
+    _float = float
     rows = []
-    for r in records:
-        desc = r.get("描述", "").strip()
-        if not desc:
+    for desc, amount_str, dt in zip(*section_columns(section, "描述", "金额", "日期")):
+        if not desc.strip():
             continue
-        amount_str = r.get("金额", "").strip()
-        if not amount_str:
+        # float() 本身忽略首尾空白，这里只需判断是否为空
+        if not amount_str.strip():
             continue
-        amount = float(amount_str)
+        amount = _float(amount_str)
         if amount <= 0:
             continue
 
-        dt = r.get("日期", "").strip()
+        dt = dt.strip()
         if dt:
             dt += " 0:00:00"
 
-        rows.append({
-            "Symbol": "$CASH",
-            "Side": "Dividend",
-            "Qty": amount,
-            "Fill Price": "",
-            "Commission": "",
-            "Closing Time": dt,
-        })
+        rows.append(("$CASH", "Dividend", amount, "", "", dt))
     return rows
 
 
-def convert_taxes(records):
+def convert_taxes(section):
     """将代扣税记录转换为 TradingView $CASH Taxes and fees 格式。"""
+    _float = float
+    _abs = abs
     rows = []
-    for r in records:
-        desc = r.get("描述", "").strip()
-        if not desc:
+    for desc, amount_str, dt in zip(*section_columns(section, "描述", "金额", "日期")):
+        if not desc.strip():
             continue
-        amount_str = r.get("金额", "").strip()
-        if not amount_str:
+        # float() 本身忽略首尾空白，这里只需判断是否为空
+        if not amount_str.strip():
             continue
-        amount = float(amount_str)
+        amount = _float(amount_str)
         if amount >= 0:
             continue  # 代扣税应为负数
 
-        dt = r.get("日期", "").strip()
+        dt = dt.strip()
         if dt:
             dt += " 0:00:00"
 
-        rows.append({
-            "Symbol": "$CASH",
-            "Side": "Taxes and fees",
-            "Qty": abs(amount),
-            "Fill Price": "",
-            "Commission": "",
-            "Closing Time": dt,
-        })
+        rows.append(("$CASH", "Taxes and fees", _abs(amount), "", "", dt))
     return rows
 
 
 def process_activity_statement(filepath, symbol_exchange_map):
-    """处理单个 Activity Statement 文件，返回所有转换后的行。"""
-    sections = parse_activity_statement(filepath)
+    """处理单个 Activity Statement 文件，返回所有转换后的行（已按 Closing Time 排序）。"""
+    sections = parse_activity_statement(filepath, CONVERTED_SECTIONS)
     rows = []
 
-    rows += convert_trades(sections.get("交易", []), symbol_exchange_map)
-    rows += convert_cash_transactions(sections.get("存款和取款", []), "")
-    rows += convert_dividends(sections.get("股息", []))
-    rows += convert_taxes(sections.get("代扣税", []))
+    rows += convert_trades(sections.get("交易"), symbol_exchange_map)
+    rows += convert_cash_transactions(sections.get("存款和取款"), "")
+    rows += convert_dividends(sections.get("股息"))
+    rows += convert_taxes(sections.get("代扣税"))
 
+    # 在处理单个文件时就排好序，多文件时排序随之在各工作进程中完成，主进程只需归并
+    rows.sort(key=closing_time_key)
     return rows
 
 
+# 排序键：按 Closing Time（第 6 列）排序，缺失（空字符串）时排在最前。
+# 用 itemgetter 取列，排序与归并时的取键都在 C 层完成，不必为每行调用 Python 函数。
+closing_time_key = operator.itemgetter(5)
+
+
 def main():
     parser = argparse.ArgumentParser(description="IBKR Activity Statement → TradingView Portfolio CSV 转换器")
     parser.add_argument("inputs", nargs="+", help="IBKR Activity Statement CSV 文件路径")
     parser.add_argument("--flex", nargs="*", default=[], metavar="FLEX_CSV",
                         help="IBKR Flex Query CSV 文件（用于补充交易所映射）")
     parser.add_argument("-o", "--output", default="output.csv", help="输出文件路径（默认：output.csv）")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="并行处理输入文件的进程数（默认：CPU 核心数；1 表示不使用多进程）")
     args = parser.parse_args()
 
     symbol_exchange_map = build_symbol_exchange_map(args.flex)
     print(f"交易所映射：{len(symbol_exchange_map)} 个 Symbol")
 
-    all_rows = []
-    for filepath in args.inputs:
-        rows = process_activity_statement(filepath, symbol_exchange_map)
-        trades = sum(1 for r in rows if r["Side"] in ("Buy", "Sell"))
-        cash = sum(1 for r in rows if r["Side"] not in ("Buy", "Sell"))
+    # 各 Activity Statement 互不依赖，多个文件时用进程池并行处理
+    process = functools.partial(process_activity_statement, symbol_exchange_map=symbol_exchange_map)
+    jobs = min(args.jobs or os.cpu_count() or 1, len(args.inputs))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            per_file_rows = list(executor.map(process, args.inputs))
+    else:
+        per_file_rows = [process(filepath) for filepath in args.inputs]
+
+    for filepath, rows in zip(args.inputs, per_file_rows):
+        trades = sum(1 for r in rows if r[1] in TRADE_SIDES)
+        cash = len(rows) - trades
         print(f"  {filepath}: {trades} 笔交易 + {cash} 笔现金记录")
-        all_rows.extend(rows)
 
-    # 去重（两个 Activity Statement 时间段可能有重叠）
+    # 多个文件按时间归并，边去重边写出（两个 Activity Statement 时间段可能有重叠）。
+    # heapq.merge 对时间相同的行保持文件顺序，结果与"合并 → 去重 → 稳定排序"一致。
+    # 重复行的 Closing Time 必然相同，且合并后按时间有序，因此 seen 只需保存当前时间点的行，
+    # 时间一变即可清空，内存占用与文件行数无关。
+    # Symbol、Side、Qty、Fill Price、Closing Time 均相同视为同一条记录；窗口内 Closing Time
+    # 恒定，因此去重键只需前四列，一次切片即可得到（Commission 不参与比较）。
     seen = set()
-    deduped = []
-    for r in all_rows:
-        key = (r["Symbol"], r["Side"], r["Qty"], r["Fill Price"], r["Closing Time"])
-        if key not in seen:
+    seen_time = None
+    written = 0
+    # 1 MB 写缓冲，减少逐行写出时的系统调用次数
+    with open(args.output, "w", newline="", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE) as f:
+        writer = csv.writer(f)
+        writer.writerow(TV_FIELDNAMES)
+        writerow = writer.writerow
+        for r in heapq.merge(*per_file_rows, key=closing_time_key):
+            if r[5] != seen_time:
+                seen.clear()
+                seen_time = r[5]
+            key = r[:4]
+            if key in seen:
+                continue
             seen.add(key)
-            deduped.append(r)
-
-    # 按时间排序
-    deduped.sort(key=lambda r: r["Closing Time"] or "")
-
-    with open(args.output, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=TV_FIELDNAMES)
-        writer.writeheader()
-        writer.writerows(deduped)
+            writerow(r)
+            written += 1
 
-    print(f"\n完成！共 {len(deduped)} 条记录 → {args.output}")
+    print(f"\n完成！共 {written} 条记录 → {args.output}")
 
 
 if __name__ == "__main__":